@@ -1,4 +1,5 @@
 # app/agent_worker.py
+import asyncio
 import os
 from pathlib import Path
 
@@ -16,6 +17,7 @@ except Exception:
 
 from livekit.agents import AgentSession, Agent, JobContext, WorkerOptions, AutoSubscribe, cli
 from livekit.plugins import openai as oai
+from openai.types.beta.realtime.session import TurnDetection
 
 SYSTEM_PROMPT = (
     "You are Arogya Hospital’s call assistant. Greet once. "
@@ -25,6 +27,7 @@ SYSTEM_PROMPT = (
 
 REALTIME_MODEL = os.getenv("OPENAI_REALTIME_MODEL", "gpt-4o-realtime-preview")
 VOICE = os.getenv("OPENAI_VOICE", "alloy")
+VAD_SILENCE_MS = int(os.getenv("OPENAI_VAD_SILENCE_MS", "300"))
 
 async def entrypoint(ctx: JobContext):
     # Tiny sanity check (won't print secrets)
@@ -41,6 +44,13 @@ async def entrypoint(ctx: JobContext):
             model=REALTIME_MODEL,
             voice=VOICE,
             modalities=["audio", "text"],
+            # end the caller's turn server-side after a short pause
+            turn_detection=TurnDetection(
+                type="server_vad",
+                silence_duration_ms=VAD_SILENCE_MS,
+                create_response=True,
+                interrupt_response=True,
+            ),
         )
     )
 
@@ -50,13 +60,14 @@ async def entrypoint(ctx: JobContext):
         agent=Agent(instructions=SYSTEM_PROMPT),
     )
 
-    # Greet once after the caller actually speaks (prevents greeting loops)
-    greeted = {"sent": False}
+    # Greet once after the caller actually speaks (prevents greeting loops).
+    # Session events fire on this job's loop, so check-then-set never interleaves.
+    greeted = asyncio.Event()
 
     @session.on("user_input_transcribed")
     def _on_user_transcribed(ev):
-        if not greeted["sent"] and getattr(ev, "is_final", False):
-            greeted["sent"] = True
+        if not greeted.is_set() and getattr(ev, "is_final", False):
+            greeted.set()
             ctx.create_task(session.generate_reply(
                 instructions=("Hello! May I have your name, the reason for your call, "
                               "and a preferred date/time?")
@@ -64,9 +75,13 @@ async def entrypoint(ctx: JobContext):
 
     # Fallback: if nobody speaks for 4s, greet once
     async def _fallback():
-        await ctx.sleep(4.0)
-        if not greeted["sent"]:
-            greeted["sent"] = True
+        try:
+            await asyncio.wait_for(greeted.wait(), timeout=4.0)
+            return
+        except asyncio.TimeoutError:
+            pass
+        if not greeted.is_set():
+            greeted.set()
             await session.generate_reply(
                 instructions=("Hello! May I have your name, the reason for your call, "
                               "and a preferred date/time?")
@@ -1,154 +1,423 @@
 import asyncio
+import hashlib
+import io
+import json
 import os
-import subprocess
-import tempfile
-from typing import List, Dict, Tuple, Optional
+import re
+from typing import List, Dict, Tuple, Optional, AsyncIterator
 
 import numpy as np
 import soundfile as sf
+import webrtcvad
+from cachetools import TTLCache
 from livekit import api as lk_api
 from livekit import rtc
 from livekit.rtc.audio_stream import AudioStream
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 LK_URL = os.getenv("LIVEKIT_URL")
 LK_KEY = os.getenv("LIVEKIT_API_KEY")
 LK_SECRET = os.getenv("LIVEKIT_API_SECRET")
 
-client = OpenAI()
+# Degraded mode: this STT -> LLM -> TTS loop is only for deployments without the
+# OpenAI Realtime API. Production calls are dispatched to agent_worker.py, which
+# runs speech-to-speech with server-side VAD; nothing in the backend starts
+# run_ai_agent, it has to be launched on its own for a room.
+
+client = AsyncOpenAI()
+
+# Kept static (no per-call fields) so every request shares a cacheable prefix
+SYSTEM_PROMPT = (
+    "You are Arogya hospital’s helpful call assistant. "
+    "Greet, collect name, purpose, and preferred date/time. "
+    "Keep responses to 1–2 sentences."
+)
+HISTORY_MAX_TURNS = 6  # user+assistant pairs sent back to the LLM
+
+# VAD endpointing for the STT fallback loop (webrtcvad accepts 10/20/30 ms frames)
+VAD_FRAME_MS = 20
+VAD_MIN_SPEECH_MS = 200
+VAD_TRAILING_SILENCE_MS = 300
+MAX_UTTERANCE_MS = 10_000
+NO_SPEECH_WINDOW_MS = 4000
+VAD_PREROLL_MS = 300  # leading silence kept in front of the first speech frame
+PCM_BUFFER_S = 12  # headroom over MAX_UTTERANCE_MS
+
+# OpenAI's "pcm" speech format: raw 16-bit little-endian, 24 kHz mono
+TTS_SAMPLE_RATE = 24000
+TTS_CHANNELS = 1
+
+# LLM replies are spoken sentence by sentence as they stream in
+# a terminator only ends a sentence once whitespace follows ("10.30" stays whole)
+_SENTENCE_END_RE = re.compile(r"[.!?]+(?=\s)")
+_ABBREVIATIONS = {"dr", "mr", "mrs", "ms", "st", "prof"}
+_DOTTED_ABBREV_RE = re.compile(r"(?:[a-z]\.)+[a-z]")  # a.m, p.m, e.g, i.e
+SENTENCE_SOFT_CAP_WORDS = 12
+
+# replies for near-identical turns ("yes", "no", ...) given the same recent context
+CACHE_HISTORY_MESSAGES = 4
+_resp_cache: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+_PUNCT_RE = re.compile(r"[^\w\s]")
 
 # ---------- helpers ----------
-async def _ensure_wav_bytes(raw_bytes: bytes) -> Tuple[np.ndarray, int, int]:
-    with tempfile.NamedTemporaryFile(suffix=".blob", delete=False) as f:
-        f.write(raw_bytes)
-        in_path = f.name
-    try:
-        data, sr = sf.read(in_path, dtype="int16", always_2d=True)
-        return data, sr, data.shape[1]
-    except RuntimeError:
-        pass
-    wav_path = in_path + ".wav"
-    subprocess.run(
-        ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", in_path, wav_path],
-        check=True,
-    )
-    data, sr = sf.read(wav_path, dtype="int16", always_2d=True)
-    return data, sr, data.shape[1]
-
-async def _write_wav_from_pcm16(pcm_bytes: bytes, sample_rate: int, channels: int) -> str:
-    arr = np.frombuffer(pcm_bytes, dtype=np.int16).reshape((-1, max(1, channels)))
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
-        sf.write(f.name, arr, samplerate=sample_rate, subtype="PCM_16")
-        return f.name
+def _write_wav_from_pcm16(pcm: np.ndarray, sample_rate: int, channels: int) -> io.BytesIO:
+    # mono stays a flat 1-D view; only interleaved multi-channel audio needs (N, ch)
+    arr = pcm.reshape((-1, channels)) if channels > 1 else pcm.reshape(-1)
+    buf = io.BytesIO()
+    sf.write(buf, arr, sample_rate, format="WAV", subtype="PCM_16")
+    buf.seek(0)
+    return buf
+
+def _normalize_prompt(text: str) -> str:
+    return " ".join(_PUNCT_RE.sub(" ", text.lower()).split())
+
+def _cache_key(prompt: str, history: List[Dict[str, str]], model: str) -> bytes:
+    recent = json.dumps(history[-CACHE_HISTORY_MESSAGES:], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(f"{model}|{_normalize_prompt(prompt)}|{recent}".encode("utf-8")).digest()
+
+def _pop_sentences(text: str) -> Tuple[List[str], str]:
+    # complete sentences in text, plus the unterminated remainder
+    sentences: List[str] = []
+    start = 0
+    for m in _SENTENCE_END_RE.finditer(text):
+        if m.group() == ".":
+            words = text[start:m.start()].split()
+            last = words[-1].lstrip("(\"'").lower() if words else ""
+            if last in _ABBREVIATIONS or _DOTTED_ABBREV_RE.fullmatch(last):
+                continue  # "Dr. Rao", "10:30 a.m. on Monday"
+            following = text[m.end():].lstrip()
+            if not following:
+                break  # can't tell yet whether the next word starts a sentence
+            if following[0].islower():
+                continue
+        sentence = text[start:m.end()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = m.end()
+    return sentences, text[start:]
 
 # ---------- TTS / STT / LLM ----------
-async def speak(room: rtc.Room, text: str) -> None:
+async def _fetch_tts(text: str, chunks: asyncio.Queue) -> None:
+    # stream raw PCM for one sentence into chunks; None marks the end
+    bytes_per_chunk = int(TTS_SAMPLE_RATE * 0.02) * 2 * TTS_CHANNELS  # 20 ms
     try:
-        speech = client.audio.speech.create(
-            model=os.getenv("OPENAI_TTS_MODEL", "tts-1"),
-            voice=os.getenv("OPENAI_VOICE", "alloy"),
-            input=text,
-            response_format="wav",
-        )
-    except TypeError:
-        speech = client.audio.speech.create(
+        async with client.audio.speech.with_streaming_response.create(
             model=os.getenv("OPENAI_TTS_MODEL", "tts-1"),
             voice=os.getenv("OPENAI_VOICE", "alloy"),
             input=text,
-        )
+            response_format="pcm",
+        ) as resp:
+            async for chunk in resp.iter_bytes(chunk_size=bytes_per_chunk):
+                await chunks.put(chunk)
+    except Exception as e:
+        print("[AI] TTS error:", e)
+    finally:
+        await chunks.put(None)
 
-    data, sr, ch = await _ensure_wav_bytes(speech.read())
-    source = rtc.AudioSource(sample_rate=sr, num_channels=ch)
+async def speak_stream(room: rtc.Room, sentences: AsyncIterator[str]) -> List[str]:
+    # One track per reply. The producer starts TTS for sentence N+1 while N plays;
+    # order_q holding one item bounds the lookahead to a single sentence.
+    source = rtc.AudioSource(sample_rate=TTS_SAMPLE_RATE, num_channels=TTS_CHANNELS)
     track = rtc.LocalAudioTrack.create_audio_track("agent-tts", source)
     pub = await room.local_participant.publish_track(track)
 
-    samples_per_chunk = int(sr * 0.02)  # 20 ms
-    i = 0
-    while i < len(data):
-        chunk = data[i:i + samples_per_chunk]
-        if chunk.size == 0:
-            break
-        frame = rtc.AudioFrame(
-            data=chunk.tobytes(),
-            sample_rate=sr,
-            num_channels=ch,
-            samples_per_channel=len(chunk),
-        )
-        await source.capture_frame(frame)
-        await asyncio.sleep(0.02)
-        i += samples_per_chunk
+    order_q: "asyncio.Queue[Optional[asyncio.Queue]]" = asyncio.Queue(maxsize=1)
+    spoken: List[str] = []
+    fetches: set[asyncio.Task] = set()
 
+    async def _producer() -> None:
+        try:
+            async for text in sentences:
+                spoken.append(text)
+                chunks: asyncio.Queue = asyncio.Queue()
+                await order_q.put(chunks)
+                t = asyncio.create_task(_fetch_tts(text, chunks))
+                fetches.add(t)
+                t.add_done_callback(fetches.discard)
+        finally:
+            await order_q.put(None)
+
+    producer = asyncio.create_task(_producer())
+    loop = asyncio.get_running_loop()
     try:
-        result = room.local_participant.unpublish_track(pub.sid)
-        if asyncio.iscoroutine(result):
-            await result
-    except Exception:
-        pass
-
-async def transcribe_pcm_chunk(pcm_bytes: bytes, sample_rate: int, channels: int) -> str:
-    wav_path = await _write_wav_from_pcm16(pcm_bytes, sample_rate, channels)
-    tr = client.audio.transcriptions.create(
+        while (chunks := await order_q.get()) is not None:
+            # pace each sentence against a monotonic deadline so timer jitter doesn't accumulate
+            start = None
+            samples_sent = 0
+            while (chunk := await chunks.get()) is not None:
+                chunk = chunk[:len(chunk) - len(chunk) % (2 * TTS_CHANNELS)]
+                if not chunk:
+                    continue
+                frame = rtc.AudioFrame(
+                    data=chunk,
+                    sample_rate=TTS_SAMPLE_RATE,
+                    num_channels=TTS_CHANNELS,
+                    samples_per_channel=len(chunk) // (2 * TTS_CHANNELS),
+                )
+                await source.capture_frame(frame)
+                if start is None:
+                    start = loop.time()
+                samples_sent += frame.samples_per_channel
+                await asyncio.sleep(max(0.0, start + samples_sent / TTS_SAMPLE_RATE - loop.time()))
+        await producer  # surface LLM errors
+        # let the source's internal queue drain before the track goes away
+        await source.wait_for_playout()
+    finally:
+        producer.cancel()
+        for t in list(fetches):
+            t.cancel()
+        try:
+            result = room.local_participant.unpublish_track(pub.sid)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            pass
+    return spoken
+
+async def speak(room: rtc.Room, text: str) -> None:
+    async def _one() -> AsyncIterator[str]:
+        yield text
+    await speak_stream(room, _one())
+
+async def _transcribe_one(pcm: np.ndarray, sample_rate: int, channels: int) -> str:
+    buf = await asyncio.to_thread(_write_wav_from_pcm16, pcm, sample_rate, channels)
+    tr = await client.audio.transcriptions.create(
         model=os.getenv("OPENAI_STT_MODEL", "whisper-1"),
-        file=open(wav_path, "rb"),
+        file=("chunk.wav", buf, "audio/wav"),
     )
     return (tr.text or "").strip()
 
-async def converse(prompt: str, history: List[Dict[str, str]]) -> str:
+class STTBatcher:
+    # Process-wide: takes whatever utterances from every room are already queued
+    # (up to max_batch), groups them by duration bucket and dispatches each group
+    # together. Against the OpenAI API a group is only a concurrent fan-out, so
+    # nothing is held back (max_wait=0); a local batched Whisper backend that pads
+    # each bucket into one call can set max_wait to trade latency for batch size.
+    BUCKETS_S = (4.0, 10.0)
+
+    def __init__(self, max_batch: int = 8, max_wait: float = 0.0):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._inflight: set[asyncio.Task] = set()
+
+    def _bucket(self, pcm: np.ndarray, sample_rate: int, channels: int) -> int:
+        seconds = pcm.size / (max(1, channels) * sample_rate)
+        for i, limit in enumerate(self.BUCKETS_S):
+            if seconds < limit:
+                return i
+        return len(self.BUCKETS_S)
+
+    def _ensure_running(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._run())
+
+    async def submit(self, pcm: np.ndarray, sample_rate: int, channels: int) -> str:
+        self._ensure_running()
+        fut = self._loop.create_future()
+        await self._queue.put((pcm, sample_rate, channels, fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            buckets: Dict[int, list] = {}
+            for item in batch:
+                buckets.setdefault(self._bucket(*item[:3]), []).append(item)
+            for items in buckets.values():
+                self._dispatch(items)
+
+    def _dispatch(self, items: list) -> None:
+        # one task per utterance so each caller gets its transcript as soon as its
+        # own request returns, not when the slowest request in the bucket does
+        for pcm, sr, ch, fut in items:
+            t = self._loop.create_task(_transcribe_one(pcm, sr, ch))
+            self._inflight.add(t)
+            t.add_done_callback(self._inflight.discard)
+            t.add_done_callback(lambda t, fut=fut: self._resolve(fut, t))
+
+    @staticmethod
+    def _resolve(fut: asyncio.Future, task: asyncio.Task) -> None:
+        if fut.done():
+            return
+        if task.cancelled():
+            fut.cancel()
+        elif task.exception() is not None:
+            fut.set_exception(task.exception())
+        else:
+            fut.set_result(task.result())
+
+stt_batcher = STTBatcher()
+
+async def transcribe_pcm_chunk(pcm: np.ndarray, sample_rate: int, channels: int) -> str:
+    return await stt_batcher.submit(pcm, sample_rate, channels)
+
+async def converse(prompt: str, history: List[Dict[str, str]]) -> AsyncIterator[str]:
+    model = os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini")
+    key = _cache_key(prompt, history, model)
+    cached = _resp_cache.get(key)
+    if cached is not None:
+        for sentence in cached:
+            yield sentence
+        return
+
     msgs = [
-        {"role": "system", "content": (
-            "You are Arogya hospital’s helpful call assistant. "
-            "Greet, collect name, purpose, and preferred date/time. "
-            "Keep responses to 1–2 sentences."
-        )},
+        {"role": "system", "content": SYSTEM_PROMPT},
         *history,
         {"role": "user", "content": prompt},
     ]
-    r = client.chat.completions.create(
-        model=os.getenv("OPENAI_CHAT_MODEL", "gpt-4o-mini"),
+    stream = await client.chat.completions.create(
+        model=model,
         messages=msgs,
         temperature=0.3,
+        stream=True,
     )
-    return r.choices[0].message.content
+
+    sentences: List[str] = []
+    pending = ""
+    async for chunk in stream:
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        pending += chunk.choices[0].delta.content
+
+        done, pending = _pop_sentences(pending)
+        for sentence in done:
+            sentences.append(sentence)
+            yield sentence
+
+        # no terminator yet: flush long runs, keeping the last (maybe partial) word
+        if len(pending.split()) > SENTENCE_SOFT_CAP_WORDS:
+            last_gap = re.search(r"\s\S*$", pending.rstrip())
+            if last_gap:
+                cut = last_gap.start()
+                sentences.append(pending[:cut].strip())
+                yield sentences[-1]
+                pending = pending[cut:]
+
+    if pending.strip():
+        sentences.append(pending.strip())
+        yield sentences[-1]
+    if sentences:
+        _resp_cache[key] = tuple(sentences)
 
 # ---------- loop over remote SIP audio ----------
 async def stt_turn_loop(room: rtc.Room, remote_track: rtc.RemoteAudioTrack) -> None:
     astream = AudioStream.from_track(track=remote_track, sample_rate=16000, num_channels=1)
 
+    stt_q: "asyncio.Queue[Optional[Tuple[np.ndarray, int, int]]]" = asyncio.Queue()
+    llm_q: "asyncio.Queue[Optional[str]]" = asyncio.Queue()
+    handoff = asyncio.Event()
     history: List[Dict[str, str]] = []
-    sample_rate: Optional[int] = None
-    channels: Optional[int] = None
-    window_ms = 3000
-    pcm_buf = bytearray()
 
-    try:
-        async for ev in astream:
-            frame = ev.frame
-            if sample_rate is None:
-                sample_rate = frame.sample_rate
-                channels = frame.num_channels
-
-            pcm_buf.extend(frame.data)
-            duration_ms = int(1000 * frame.samples_per_channel / frame.sample_rate)
-            window_ms -= duration_ms
-
-            if window_ms > 0:
-                continue
-
-            window_ms = 3000
-            text = await transcribe_pcm_chunk(bytes(pcm_buf), sample_rate, channels)
-            pcm_buf.clear()
-            if not text:
+    # pcm -> stt_q -> STT -> llm_q -> LLM + TTS, each stage its own task so the
+    # next utterance is transcribed while the previous reply is still playing
+    async def _audio_segmenter() -> None:
+        sample_rate: Optional[int] = None
+        channels: Optional[int] = None
+        vad = webrtcvad.Vad(2)
+        vad_samples = 0
+        # preallocated int16 buffer, frames are copied straight in; a flushed
+        # utterance is handed off as a view and a fresh buffer takes its place
+        pcm_buf = np.empty(0, dtype=np.int16)  # flat, interleaved if channels > 1
+        write_idx = 0
+        vad_idx = 0  # values already classified by the VAD
+        buffered_ms = speech_ms = silence_ms = 0
+        try:
+            async for ev in astream:
+                if handoff.is_set():
+                    break
+                frame = ev.frame
+                if sample_rate is None:
+                    sample_rate = frame.sample_rate
+                    channels = frame.num_channels
+                    vad_samples = int(sample_rate * VAD_FRAME_MS / 1000) * channels
+                    pcm_buf = np.empty(sample_rate * PCM_BUFFER_S * channels, dtype=np.int16)
+
+                n = frame.samples_per_channel * channels
+                pcm_buf[write_idx:write_idx + n] = np.frombuffer(frame.data, dtype=np.int16)
+                write_idx += n
+                while write_idx - vad_idx >= vad_samples:
+                    sub = pcm_buf[vad_idx:vad_idx + vad_samples].tobytes()
+                    vad_idx += vad_samples
+                    buffered_ms += VAD_FRAME_MS
+                    if vad.is_speech(sub, sample_rate):
+                        speech_ms += VAD_FRAME_MS
+                        silence_ms = 0
+                    else:
+                        silence_ms += VAD_FRAME_MS
+
+                # nothing heard yet: keep only a short pre-roll instead of a growing silent window
+                preroll = vad_samples * (VAD_PREROLL_MS // VAD_FRAME_MS)
+                if speech_ms == 0 and vad_idx > preroll:
+                    keep = write_idx - (vad_idx - preroll)
+                    pcm_buf[:keep] = pcm_buf[vad_idx - preroll:write_idx]
+                    write_idx, vad_idx = keep, preroll
+                    buffered_ms = VAD_PREROLL_MS
+
+                end_of_turn = speech_ms >= VAD_MIN_SPEECH_MS and silence_ms >= VAD_TRAILING_SILENCE_MS
+                too_long = buffered_ms >= MAX_UTTERANCE_MS
+                # only ever at a pause, so a caller who starts talking isn't cut mid-word
+                no_speech = (speech_ms < VAD_MIN_SPEECH_MS and silence_ms >= VAD_TRAILING_SILENCE_MS
+                             and buffered_ms >= NO_SPEECH_WINDOW_MS)
+                if not (end_of_turn or too_long or no_speech):
+                    continue
+
+                # isolated blips (< VAD_MIN_SPEECH_MS) still get the old fixed-window flush
+                if speech_ms > 0:
+                    await stt_q.put((pcm_buf[:write_idx], sample_rate, channels))
+                    pcm_buf = np.empty_like(pcm_buf)
+                write_idx = vad_idx = 0
+                buffered_ms = speech_ms = silence_ms = 0
+        finally:
+            await stt_q.put(None)
+
+    async def _stt_worker() -> None:
+        try:
+            while (item := await stt_q.get()) is not None:
+                if handoff.is_set():
+                    continue
+                text = await transcribe_pcm_chunk(*item)
+                if text:
+                    await llm_q.put(text)
+        finally:
+            await llm_q.put(None)
+
+    async def _dialog_worker() -> None:
+        while (text := await llm_q.get()) is not None:
+            if handoff.is_set():
                 continue
-
             print(f"[AI] Heard: {text}")
             if any(k in text.lower() for k in ("agent", "human", "representative", "operator")):
+                handoff.set()
                 await speak(room, "Okay, connecting you to a human agent.")
-                break
+                continue
 
-            reply = await converse(text, history)
-            history += [{"role": "user", "content": text}, {"role": "assistant", "content": reply}]
+            reply = " ".join(await speak_stream(room, converse(text, history)))
+            history.append({"role": "user", "content": text})
+            history.append({"role": "assistant", "content": reply})
+            history[:] = history[-2 * HISTORY_MAX_TURNS:]
             print(f"[AI] Reply: {reply}")
-            await speak(room, reply)
+
+    try:
+        await asyncio.gather(_audio_segmenter(), _stt_worker(), _dialog_worker())
     finally:
         await astream.aclose()
 
@@ -164,16 +433,8 @@ async def run_ai_agent(room_name: str) -> None:
     )
 
     room = rtc.Room()
-    try:
-        room.on_connection_state_changed(lambda s: print(f"[AI] state={s} room={room_name}"))
-    except Exception:
-        pass
-
-    print(f"[AI] connecting… url={LK_URL} identity={identity} room={room_name}")
-    await room.connect(LK_URL, token)
-    print("[AI] joined", room_name)
-
     started = asyncio.Event()
+    done = asyncio.Event()
 
     async def _start_if_audio_track(track, participant):
         if started.is_set():
@@ -194,6 +455,7 @@ async def run_ai_agent(room_name: str) -> None:
                 await _start_if_audio_track(track, participant)
             return
 
+        # the audio loop starts from the "track_subscribed" event
         sid = getattr(pub, "sid", "?")
         print(f"[AI] subscribing to publication sid={sid} of {getattr(participant, 'identity', '')}")
         try:
@@ -202,14 +464,12 @@ async def run_ai_agent(room_name: str) -> None:
                 await result
         except Exception as e:
             print("[AI] set_subscribed error:", e)
-            return
 
-        try:
-            pub.on_subscribed(lambda track: asyncio.create_task(_start_if_audio_track(track, participant)))
-        except Exception:
-            track = getattr(pub, "track", None)
-            if track:
-                await _start_if_audio_track(track, participant)
+    async def _subscribe_participant(participant):
+        pubs = getattr(participant, "track_publications", {})
+        pubs = pubs.values() if isinstance(pubs, dict) else pubs
+        for pub in list(pubs or []):
+            await _subscribe_pub(pub, participant)
 
     async def _sweep_and_subscribe_all():
         rps = getattr(room, "remote_participants", {})
@@ -218,49 +478,42 @@ async def run_ai_agent(room_name: str) -> None:
             print("[AI] sweep: no remote participants yet")
             return
         for rp in rp_values:
-            pubs = getattr(rp, "track_publications", {})
-            pubs = pubs.values() if isinstance(pubs, dict) else pubs
-            for pub in pubs or []:
-                await _subscribe_pub(pub, rp)
+            await _subscribe_participant(rp)
 
-    try:
-        def _on_track_published(pub, participant):
-            asyncio.create_task(_subscribe_pub(pub, participant))
-        off_published = room.on_track_published(_on_track_published)
-    except Exception:
-        def off_published(): pass
+    # livekit.rtc.Room is an EventEmitter; handlers go on before connect so no event is missed
+    def _on_track_subscribed(track, pub, participant):
+        asyncio.create_task(_start_if_audio_track(track, participant))
+
+    def _on_track_published(pub, participant):
+        asyncio.create_task(_subscribe_pub(pub, participant))
+
+    def _on_participant_connected(participant):
+        asyncio.create_task(_subscribe_participant(participant))
+
+    handlers = {
+        "connection_state_changed": lambda s: print(f"[AI] state={s} room={room_name}"),
+        "track_subscribed": _on_track_subscribed,
+        "track_published": _on_track_published,
+        "participant_connected": _on_participant_connected,
+        "disconnected": lambda *_: done.set(),
+    }
+    for event, cb in handlers.items():
+        room.on(event, cb)
 
+    print(f"[AI] connecting… url={LK_URL} identity={identity} room={room_name}")
+    await room.connect(LK_URL, token)
+    print("[AI] joined", room_name)
+
+    # one sweep for participants already in the room; later tracks arrive via the events
+    await _sweep_and_subscribe_all()
     try:
-        def _on_participant_connected(participant):
-            asyncio.create_task(_sweep_and_subscribe_all())
-        off_participant = room.on_participant_connected(_on_participant_connected)
-    except Exception:
-        def off_participant(): pass
-
-    for _ in range(5):
-        await _sweep_and_subscribe_all()
-        if started.is_set():
-            break
-        await asyncio.sleep(1.0)
-
-    async def _background_sweeper():
-        for _ in range(20):
-            if started.is_set():
-                return
-            await _sweep_and_subscribe_all()
-            await asyncio.sleep(1.0)
-        if not started.is_set():
-            print("[AI][WARN] no remote audio within 20s — check SIP ingress & permissions.")
-    asyncio.create_task(_background_sweeper())
+        await asyncio.wait_for(started.wait(), timeout=20)
+    except asyncio.TimeoutError:
+        print("[AI][WARN] no remote audio within 20s — check SIP ingress & permissions.")
 
     await speak(room, "Hello! This is Arogya's automated assistant. How can I help you today?")
 
-    done = asyncio.Event()
-    try:
-        room.on_disconnected(lambda *_: done.set())
-    except Exception:
-        pass
     await done.wait()
-    off_published()
-    off_participant()
+    for event, cb in handlers.items():
+        room.off(event, cb)
     await room.disconnect()
@@ -1,9 +1,10 @@
 # backend/app/deps.py
 import os
+from datetime import timedelta
 from pathlib import Path
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from livekit import api as lk_api
 
 # Load .env from repo root or backend/.env
@@ -14,19 +15,40 @@ for p in (root_env, backend_env):
         load_dotenv(p, override=False)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./dev.db")
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(engine, expire_on_commit=False)
+
+def _async_url(url: str) -> str:
+    # plain sync URLs from .env are mapped onto their async drivers
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+ASYNC_DATABASE_URL = _async_url(DATABASE_URL)
+_pool_kwargs = {} if ASYNC_DATABASE_URL.startswith("sqlite") else {"pool_size": 20, "max_overflow": 40}
+engine = create_async_engine(ASYNC_DATABASE_URL, pool_pre_ping=True, **_pool_kwargs)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 LIVEKIT_URL = os.getenv("LIVEKIT_URL")
 LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY")
 LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
 
+# JWTs are deterministic per (identity, name, room); reuse them until ~5 min before expiry
+LK_TOKEN_TTL = timedelta(hours=1)
+_jwt_cache: TTLCache = TTLCache(maxsize=10_000, ttl=LK_TOKEN_TTL.total_seconds() - 300)
+
 def make_lk_token(identity: str, name: str, room: str) -> str:
+    key = (identity, name, room)
+    token = _jwt_cache.get(key)
+    if token is not None:
+        return token
     token = (
         lk_api.AccessToken(api_key=LIVEKIT_API_KEY, api_secret=LIVEKIT_API_SECRET)
         .with_identity(identity)
         .with_name(name)
         .with_grants(lk_api.VideoGrants(room_join=True, room=room))
+        .with_ttl(LK_TOKEN_TTL)
         .to_jwt()
     )
+    _jwt_cache[key] = token
     return token
@@ -7,8 +7,11 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from sqlalchemy import DateTime, select
-from sqlalchemy.orm import Session, Mapped, mapped_column
+from sqlalchemy import DateTime, Index, inspect, select, update, func, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from starlette.requests import ClientDisconnect
 
@@ -16,18 +19,68 @@ from .models import Base, Agent, AgentStatus, Call, CallStatus
 from .deps import SessionLocal, make_lk_token, engine
 from livekit import api as lk_api
 
+def _utcnow() -> datetime:
+    # naive UTC, matching the plain DateTime columns (asyncpg rejects aware values for them)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+LEGACY_ROOM_NAME_INDEX = "ix_calls_room_name"  # non-unique, from room_name index=True
+
+def _create_missing_indexes(conn) -> None:
+    # create_all skips tables that already exist, so add newer indexes by hand
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.unique and table is Call.__table__ and _has_duplicate_room_names(conn):
+                continue
+            index.create(conn, checkfirst=True)
+
+    existing = {ix["name"] for ix in inspect(conn).get_indexes(Call.__tablename__)}
+    if "uq_calls_room_name" in existing and LEGACY_ROOM_NAME_INDEX in existing:
+        # the unique index covers the same lookups
+        Index(LEGACY_ROOM_NAME_INDEX, Call.__table__.c.room_name).drop(conn)
+
+def _has_duplicate_room_names(conn) -> bool:
+    dupes = conn.execute(
+        select(Call.room_name)
+        .where(Call.room_name.is_not(None))
+        .group_by(Call.room_name)
+        .having(func.count() > 1)
+        .limit(5)
+    ).scalars().all()
+    if dupes:
+        print(
+            "[DB][ERROR] calls.room_name has duplicate rows "
+            f"(e.g. {', '.join(dupes)}); uq_calls_room_name not created and "
+            "webhook upserts will fail until they are merged"
+        )
+    return bool(dupes)
+
+def _get_lkapi(app: FastAPI) -> lk_api.LiveKitAPI:
+    # one HTTP session for all dispatches; built lazily so missing LIVEKIT_* envs
+    # only fail the dispatch (logged) instead of the whole app's startup
+    if app.state.lkapi is None:
+        app.state.lkapi = lk_api.LiveKitAPI()
+    return app.state.lkapi
+
 # ---------- FastAPI lifespan (replaces @on_event) ----------
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
     # startup
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # create_all skips existing tables, so indexes added later (e.g. the unique
+        # room_name index the webhook upsert needs) are created here when missing
+        await conn.run_sync(_create_missing_indexes)
+    app.state.lkapi = None  # created on first dispatch, see _get_lkapi
     yield
-    # shutdown: nothing to clean up in this variant
+    # shutdown
+    if app.state.lkapi is not None:
+        await app.state.lkapi.aclose()
+    await engine.dispose()
 
 app = FastAPI(title="Call Center Backend", lifespan=lifespan)
 
 updated_at: Mapped[datetime] = mapped_column(
-    DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc)
+    DateTime, default=lambda: _utcnow(), onupdate=lambda: _utcnow()
 )
 
 origins = ["http://localhost:5173", "http://127.0.0.1:5173"]
@@ -38,12 +91,9 @@ app.add_middleware(
 
 active_ai_tasks: dict[str, asyncio.Task] = {}
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db() -> AsyncIterator[AsyncSession]:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 # -------- Schemas --------
 class AgentCreate(BaseModel):
@@ -56,58 +106,59 @@ class TokenRequest(BaseModel):
 
 # -------- Routes --------
 @app.post("/agents/register")
-def register_agent(payload: AgentCreate, db: Session = Depends(get_db)):
-    agent = db.query(Agent).filter(Agent.username == payload.username).first()
-    now = datetime.now(timezone.utc)
+async def register_agent(payload: AgentCreate, db: AsyncSession = Depends(get_db)):
+    by_username = select(Agent).where(Agent.username == payload.username)
+    agent = (await db.execute(by_username)).scalar_one_or_none()
+    now = _utcnow()
 
     if agent:
         agent.full_name = payload.full_name or agent.full_name
         agent.status = AgentStatus.online
         agent.updated_at = now
-        db.commit()
-        db.refresh(agent)
+        await db.commit()
+        await db.refresh(agent)
         return {"agent_id": agent.id, "status": agent.status, "username": agent.username}
 
     a = Agent(username=payload.username, full_name=payload.full_name,
               status=AgentStatus.online, created_at=now, updated_at=now)
     db.add(a)
     try:
-        db.commit()
+        await db.commit()
     except IntegrityError:
-        db.rollback()
-        agent = db.query(Agent).filter(Agent.username == payload.username).first()
+        await db.rollback()
+        agent = (await db.execute(by_username)).scalar_one_or_none()
         if not agent:
             raise
         agent.full_name = payload.full_name or agent.full_name
         agent.status = AgentStatus.online
         agent.updated_at = now
-        db.commit()
-        db.refresh(agent)
+        await db.commit()
+        await db.refresh(agent)
         return {"agent_id": agent.id, "status": agent.status, "username": agent.username}
 
-    db.refresh(a)
+    await db.refresh(a)
     return {"agent_id": a.id, "status": a.status, "username": a.username}
 
 @app.post("/livekit/token")
-def get_token(req: TokenRequest, db: Session = Depends(get_db)):
-    agent = db.get(Agent, req.agent_id)
+async def get_token(req: TokenRequest, db: AsyncSession = Depends(get_db)):
+    agent = await db.get(Agent, req.agent_id)
     token = make_lk_token(identity=agent.id, name=agent.full_name, room=req.room)
     return {"token": token}
 
 @app.get("/calls/next")
-def next_call(db: Session = Depends(get_db)):
-    cutoff = datetime.now(timezone.utc) - timedelta(minutes=2)
-    call = (
-        db.query(Call)
-        .filter(Call.status == CallStatus.ringing, Call.created_at >= cutoff)
+async def next_call(db: AsyncSession = Depends(get_db)):
+    cutoff = _utcnow() - timedelta(minutes=2)
+    call = (await db.execute(
+        select(Call)
+        .where(Call.status == CallStatus.ringing, Call.created_at >= cutoff)
         .order_by(Call.created_at)
-        .first()
-    )
+        .limit(1)
+    )).scalar_one_or_none()
     return {"room": call.room_name, "call_id": call.id} if call else {"room": None}
 
 # -------- LiveKit webhook --------
 @app.post("/webhooks/livekit")
-async def livekit_webhook(request: Request, db: Session = Depends(get_db)):
+async def livekit_webhook(request: Request, db: AsyncSession = Depends(get_db)):
     try:
         body = await request.body()
         if not body:
@@ -127,29 +178,32 @@ async def livekit_webhook(request: Request, db: Session = Depends(get_db)):
     part = (payload.get("participant") or {})
     kind = part.get("kind")
 
-    def upsert_call(room_name: str, twilio_sid: Optional[str] = None, caller: Optional[str] = None):
-        call = db.execute(select(Call).where(Call.room_name == room_name)).scalar_one_or_none()
-        if call:
-            changed = False
-            if twilio_sid and not call.twilio_call_sid:
-                call.twilio_call_sid = twilio_sid; changed = True
-            if caller and not call.caller_number:
-                call.caller_number = caller; changed = True
-            if call.status == CallStatus.ended:
-                call.status = CallStatus.ringing; changed = True
-            if changed:
-                db.commit()
-            return call
-
-        new_call = Call(
+    async def upsert_call(room_name: str, twilio_sid: Optional[str] = None, caller: Optional[str] = None):
+        # one INSERT .. ON CONFLICT(room_name): fill missing SIP details, revive ended calls
+        insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+        stmt = insert(Call).values(
             room_name=room_name,
             twilio_call_sid=twilio_sid,
             caller_number=caller,
             status=CallStatus.ringing,
-            created_at=datetime.now(timezone.utc),
+            created_at=_utcnow(),
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Call.room_name],
+            set_={
+                "twilio_call_sid": func.coalesce(Call.twilio_call_sid, stmt.excluded.twilio_call_sid),
+                "caller_number": func.coalesce(Call.caller_number, stmt.excluded.caller_number),
+                "status": case((Call.status == CallStatus.ended, CallStatus.ringing), else_=Call.status),
+            },
+        )
+        await db.execute(stmt)
+
+    async def end_call(room_name: str):
+        await db.execute(
+            update(Call)
+            .where(Call.room_name == room_name, Call.status != CallStatus.ended)
+            .values(status=CallStatus.ended)
         )
-        db.add(new_call); db.commit()
-        return new_call
 
     room_name = None
     twilio_sid = None
@@ -171,15 +225,27 @@ async def livekit_webhook(request: Request, db: Session = Depends(get_db)):
         meta = ig.get("metadata") or {}
         caller = meta.get("from") or caller
 
-    if evt in ("room_started", "participant_joined", "ingress_started") and room_name:
-        upsert_call(room_name, twilio_sid, caller)
+    ended_room = None
+    if evt in ("room_finished", "ingress_ended") and room:
+        active_ai_tasks.pop(room, None)
+        ended_room = room
+    if evt in ("participant_left", "track_unpublished"):
+        p = data.get("participant", {}) or {}
+        if p.get("kind") == "SIP":
+            ended_room = data.get("room", {}).get("name")
+
+    # all DB writes for this event commit together
+    async with db.begin():
+        if evt in ("room_started", "participant_joined", "ingress_started") and room_name:
+            await upsert_call(room_name, twilio_sid, caller)
+        if ended_room:
+            await end_call(ended_room)
 
     # Start the AI once when the SIP leg joins
     if evt == "participant_joined" and kind == "SIP" and room:
         print(f"[DISPATCH] requesting agent for room {room}")
         try:
-            lkapi = lk_api.LiveKitAPI()  # uses LIVEKIT_* envs
-            await lkapi.agent_dispatch.create_dispatch(
+            await _get_lkapi(request.app).agent_dispatch.create_dispatch(
                 lk_api.CreateAgentDispatchRequest(
                     agent_name="arogya-mm-agent",  # must match worker's WorkerOptions.agent_name
                     room=room,
@@ -191,36 +257,7 @@ async def livekit_webhook(request: Request, db: Session = Depends(get_db)):
                     }),
                 )
             )
-            await lkapi.aclose()
         except Exception as e:
             print("[DISPATCH][ERROR]", e)
 
-    # Cleanup
-    if evt in ("room_finished", "ingress_ended") and room:
-        active_ai_tasks.pop(room, None)
-        call_row = db.execute(select(Call).where(Call.room_name == room)).scalar_one_or_none()
-        if call_row:
-            call_row.status = CallStatus.ended
-            db.commit()
-
-    if evt == "participant_left":
-        p = data.get("participant", {}) or {}
-        if p.get("kind") == "SIP":
-            room_name = data.get("room", {}).get("name")
-            if room_name:
-                call = db.execute(select(Call).where(Call.room_name == room_name)).scalar_one_or_none()
-                if call and call.status != CallStatus.ended:
-                    call.status = CallStatus.ended
-                    db.commit()
-
-    if evt == "track_unpublished":
-        p = data.get("participant", {}) or {}
-        if p.get("kind") == "SIP":
-            room_name = data.get("room", {}).get("name")
-            if room_name:
-                call = db.execute(select(Call).where(Call.room_name == room_name)).scalar_one_or_none()
-                if call and call.status != CallStatus.ended:
-                    call.status = CallStatus.ended
-                    db.commit()
-
     return {"ok": True}
@@ -1,6 +1,6 @@
 from datetime import datetime
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import String, DateTime, ForeignKey, Enum
+from sqlalchemy import String, DateTime, ForeignKey, Enum, Index
 import enum, uuid
 
 class Base(DeclarativeBase): pass
@@ -22,8 +22,14 @@ class CallStatus(str, enum.Enum):
 
 class Call(Base):
     __tablename__ = "calls"
+    __table_args__ = (
+        # next_call: status == ringing AND created_at >= cutoff ORDER BY created_at
+        Index("ix_calls_status_created", "status", "created_at"),
+        # webhook upserts rely on ON CONFLICT (room_name)
+        Index("uq_calls_room_name", "room_name", unique=True),
+    )
     id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    room_name: Mapped[str] = mapped_column(String(128), index=True)
+    room_name: Mapped[str] = mapped_column(String(128))
     twilio_call_sid: Mapped[str | None] = mapped_column(String(64))
     caller_number: Mapped[str | None] = mapped_column(String(32))
     assigned_agent_id: Mapped[str | None] = mapped_column(ForeignKey("agents.id"))